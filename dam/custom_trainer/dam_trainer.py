@@ -1,29 +1,47 @@
 import os
 import torch
 import torch.nn.functional as F
-from transformers import Trainer, AutoModelForCausalLM
+from transformers import Trainer, AutoConfig
 from modeling.dam import DAMLinearLayer, DAMEmbeddingLayer, DAMRMSNorm
 from safetensors.torch import save_file
 from tqdm import tqdm
-from glom import glom
 
 try:
     import wandb
 except:
     pass
 
+# Liger-Kernel ships a Triton KL-div with a fused backward; fall back to F.kl_div when
+# it is not installed
+try:
+    from liger_kernel.transformers import LigerKLDIVLoss
+    _liger_kldiv = LigerKLDIVLoss(reduction='sum', log_target=True)
+except ImportError:
+    _liger_kldiv = None
+
 def set_model_index(model, index):
     for module in model.modules():
         if isinstance(module, (DAMLinearLayer, DAMEmbeddingLayer, DAMRMSNorm, torch.nn.Linear)):
             module.model_index = index
 
-def kl_divergence_loss(logits, target_logits, non_padded_tokens, temperature=1.0):
-    # Compute the KL divergence between the log-softmax of logits and the softmax of target_logits
-    kl_div = F.kl_div(
-        F.log_softmax(logits / temperature, dim=-1),
-        F.softmax(target_logits / temperature, dim=-1),
-        reduction='batchmean'
-    )
+def kl_divergence_loss(logits, target_logits, non_padded_tokens, temperature=1.0, use_liger=True):
+    # Compute the KL divergence entirely in log space: with log_target=True, kl_div
+    # evaluates exp(log_t) * (log_t - log_p) internally, so no separate softmax of the
+    # targets is materialized and one fewer full-size intermediate is written per call
+    log_probs = F.log_softmax(logits / temperature, dim=-1)
+    target_log_probs = F.log_softmax(target_logits / temperature, dim=-1)
+
+    if use_liger and _liger_kldiv is not None:
+        # Liger's Triton kernel fuses the pointwise KL and its backward into one pass;
+        # it expects (rows, vocab) inputs and a sum reduction, so divide by the batch
+        # size afterwards to match batchmean. The inputs are fresh log-softmax outputs,
+        # so the kernel's in-place caveats do not apply here.
+        kl_div = _liger_kldiv(
+            log_probs.view(-1, log_probs.size(-1)),
+            target_log_probs.view(-1, target_log_probs.size(-1))
+        ) / logits.size(0)
+    else:
+        kl_div = F.kl_div(log_probs, target_log_probs, reduction='batchmean', log_target=True)
     
     # Scale the KL divergence by the temperature squared
     scaled_kl_div = kl_div * (temperature ** 2)
@@ -33,6 +51,63 @@ def kl_divergence_loss(logits, target_logits, non_padded_tokens, temperature=1.0
     
     return normalized_kl_div
 
+class TopKKLDivergence(torch.autograd.Function):
+    """KL divergence between a top-K target distribution and the merged model's
+    distribution normalized over the full vocabulary.
+
+    The forward computes the full-vocab log-sum-exp once and reuses it at the K
+    gathered positions, so no extra softmax pass over the vocabulary is needed.
+    The backward applies the analytic softmax-KL gradient (sum_t * p_j - t_j)
+    directly instead of replaying the generic autograd graph; because the
+    normalizer spans the whole vocabulary, the (sum_t * p_j) term is dense over
+    every logit while t_j only lives at the gathered positions.
+    """
+
+    @staticmethod
+    def forward(ctx, merged_logits, topk_logits, topk_indices, attention_mask, temperature):
+        scaled_merged = merged_logits / temperature
+        scaled_targets = topk_logits / temperature
+
+        # Normalize the gathered logits against the full vocabulary, not just the K slice
+        log_probs = scaled_merged - torch.logsumexp(scaled_merged, dim=-1, keepdim=True)
+        log_probs_at_topk = torch.gather(log_probs, dim=-1, index=topk_indices)
+
+        target_log_probs = F.log_softmax(scaled_targets, dim=-1)
+        target_probs = target_log_probs.exp()
+
+        # Mask the per-position KL contributions rather than the logits themselves:
+        # zeroed logit rows would compare a uniform-over-V merged distribution against
+        # a uniform-over-K target, adding log(V/K) per padded token instead of 0
+        per_position_kl = (target_probs * (target_log_probs - log_probs_at_topk)).sum(dim=-1)
+        kl = (per_position_kl * attention_mask).sum()
+
+        ctx.save_for_backward(target_probs, log_probs, topk_indices, attention_mask)
+        ctx.temperature = temperature
+        ctx.batch_size = merged_logits.size(0)
+        return kl / ctx.batch_size
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        target_probs, log_probs, topk_indices, attention_mask = ctx.saved_tensors
+
+        # d/dz_j of sum_k t_k (log t_k - (z_k - lse)) = (sum_k t_k) p_j - t_j: the
+        # shared normalizer makes the (sum_k t_k) p_j term dense over the vocabulary,
+        # so a sparse scatter at the gathered positions alone would let probability
+        # mass drain to the non-gathered logits for free. Compute the dense term and
+        # scatter-subtract the target probabilities at the gathered positions
+        target_mass = target_probs.sum(dim=-1, keepdim=True)
+        grad_logits = target_mass * log_probs.exp()
+        grad_logits.scatter_add_(-1, topk_indices, -target_probs)
+        grad_logits = grad_logits * attention_mask.unsqueeze(-1)
+
+        return grad_logits * (grad_output / (ctx.temperature * ctx.batch_size)), None, None, None, None
+
+def topk_kl_divergence_loss(merged_logits, topk_logits, topk_indices, attention_mask, non_padded_tokens, temperature=1.0):
+    # KL over the top-K targets with the merged distribution normalized over the
+    # full vocabulary, scaled and normalized like kl_divergence_loss
+    kl_div = TopKKLDivergence.apply(merged_logits, topk_logits, topk_indices, attention_mask, temperature)
+    return kl_div * (temperature ** 2) / non_padded_tokens
+
 def entropy_loss(logits, attention_mask, non_padded_tokens, temperature=1.0, lambda_coef_entropy=0.01):
     # Apply softmax to the logits
     probabilities = F.softmax(logits / temperature, dim=-1)
@@ -56,6 +131,32 @@ def mse_loss(logits, target_logits, non_padded_tokens, lambda_coef_mse=0.001):
     # Normalize by the number of non-padded tokens
     return lambda_coef_mse * mse_loss / non_padded_tokens
 
+def _logit_losses_core(merged_logits, individual_logits, attention_mask, non_padded_tokens,
+                       temperature, lambda_coef_mse, lambda_coef_entropy,
+                       compute_kl: bool, compute_mse: bool, compute_entropy: bool,
+                       use_liger: bool):
+    # Pure-tensor core of compute_individual_logit_losses: the masking plus the
+    # KL/MSE/entropy chains, extracted so Inductor can fuse the element-wise ops and
+    # reductions into a few kernels
+    masked_merged_logits = merged_logits * attention_mask.unsqueeze(-1)
+    masked_individual_logits = individual_logits * attention_mask.unsqueeze(-1)
+
+    zero = merged_logits.new_zeros(())
+    kl = kl_divergence_loss(masked_merged_logits, masked_individual_logits, non_padded_tokens,
+                            temperature=temperature, use_liger=use_liger) if compute_kl else zero
+    mse = mse_loss(masked_merged_logits, masked_individual_logits, non_padded_tokens,
+                   lambda_coef_mse=lambda_coef_mse) if compute_mse else zero
+    entropy = entropy_loss(masked_merged_logits, attention_mask, non_padded_tokens,
+                           temperature=temperature, lambda_coef_entropy=lambda_coef_entropy) if compute_entropy else zero
+    return kl, mse, entropy
+
+# Compile the loss core when torch.compile is available; dynamic=True covers the varying
+# sequence lengths without recompiling per batch
+if hasattr(torch, 'compile'):
+    _logit_losses = torch.compile(_logit_losses_core, dynamic=True)
+else:
+    _logit_losses = _logit_losses_core
+
 class DAMTrainer(Trainer):
     def __init__(self, model, 
                  lambda_coef_similarity=0.01,  # Added similarity regularization coefficient
@@ -70,6 +171,8 @@ class DAMTrainer(Trainer):
                  use_wandb=True,
                  generate_logits_on_fly=False,  # New parameter to control logits generation
                  use_all_logits=False,
+                 use_full_normalizer_topk_kl=False,  # Normalize top-K KL over the full vocabulary
+                 use_liger_kl=True,  # Use Liger-Kernel's fused KL-div when installed
                  report_all_metrics=False,
                  **kwargs):
         super().__init__(model=model, **kwargs)
@@ -86,43 +189,45 @@ class DAMTrainer(Trainer):
 
         self.base_model_path = base_model_path
         self.use_wandb = use_wandb
-        self.generate_logits_on_fly = generate_logits_on_fly 
+        self.generate_logits_on_fly = generate_logits_on_fly
+        self.use_full_normalizer_topk_kl = use_full_normalizer_topk_kl
+        self.use_liger_kl = use_liger_kl
 
         self.report_all_metrics = report_all_metrics
 
+        # Cache of the DAM modules in the model, filled lazily on the first compute_loss call
+        self._dam_modules = None
+
         assert not (self.use_all_logits and not self.generate_logits_on_fly), "You can't have use_all_logits=True if generate_logits_on_fly is False"
 
-    def compute_individual_logit_losses(self, merged_logits, individual_logits, attention_mask, non_padded_tokens, dataple_id):
-        masked_merged_logits = merged_logits * attention_mask.unsqueeze(-1)
-        masked_individual_logits = individual_logits * attention_mask.unsqueeze(-1)
+    def compute_individual_logit_losses(self, merged_logits, individual_logits, attention_mask, non_padded_tokens, dataple_id, kl_override=None):
+        compute_kl = (self.loss_fns['kl'] or self.report_all_metrics) and kl_override is None
+        compute_mse = self.loss_fns['mse'] or self.report_all_metrics
+        compute_entropy = self.loss_fns['entropy'] or self.report_all_metrics
+
+        kl_loss, mse_loss_value, e_loss = _logit_losses(merged_logits, individual_logits, attention_mask,
+                                                        non_padded_tokens,
+                                                        self.temperature, self.lambda_coef_mse, self.lambda_coef_entropy,
+                                                        compute_kl, compute_mse, compute_entropy,
+                                                        self.use_liger_kl)
+        # A caller may supply a pre-computed KL (e.g. the full-vocabulary top-K form)
+        if kl_override is not None:
+            kl_loss = kl_override
 
         total_loss = 0.0
         loss_logs = {}
 
         if self.loss_fns['kl'] or self.report_all_metrics:
-            kl_loss = kl_divergence_loss(masked_merged_logits, 
-                                            masked_individual_logits, 
-                                            non_padded_tokens, 
-                                            temperature=self.temperature)
             loss_logs[f'kl_loss_{dataple_id}'] = kl_loss
             if self.loss_fns['kl']:
                 total_loss += kl_loss
 
         if self.loss_fns['mse'] or self.report_all_metrics:
-            mse_loss_value = mse_loss(masked_merged_logits,
-                                        masked_individual_logits, 
-                                        non_padded_tokens,
-                                        lambda_coef_mse=self.lambda_coef_mse)
             loss_logs[f'mse_loss_{dataple_id}'] = mse_loss_value
             if self.loss_fns['mse']:
                 total_loss += mse_loss_value
 
         if self.loss_fns['entropy'] or self.report_all_metrics:
-            e_loss = entropy_loss(masked_merged_logits, 
-                                    attention_mask, 
-                                    non_padded_tokens,
-                                    temperature=self.temperature,
-                                    lambda_coef_entropy=self.lambda_coef_entropy)
             loss_logs[f'entropy_loss_{dataple_id}'] = e_loss
             if self.loss_fns['entropy']:
                 total_loss += e_loss
@@ -132,87 +237,123 @@ class DAMTrainer(Trainer):
     def compute_loss(self, merged_model, inputs, return_outputs=False):
         # Ensure the merged_model is on the correct device
         device = merged_model.device
-        
-        # Dynamically identify the number of input types (e.g., input_ids_1, input_ids_2, etc.)
-        input_keys = [key for key in inputs.keys() if key.startswith('input_ids_')]
-        num_datasets = len(input_keys)
-
-        # Prepare dictionaries to store input_ids and attention_masks
-        input_ids_dict = {}
-        attention_mask_dict = {}
-        
-        for dataset_idx in range(1, num_datasets + 1):
-            input_ids_dict[f'input_ids_{dataset_idx}'] = inputs[f'input_ids_{dataset_idx}'].to(device)
-            attention_mask_dict[f'attention_mask_{dataset_idx}'] = inputs[f'attention_mask_{dataset_idx}'].to(device)
-
-        # Compute logits for the merged model separately for each input
-        merged_logits_dict = {}
-        for dataset_idx in range(1, num_datasets + 1):
-            input_ids = input_ids_dict[f'input_ids_{dataset_idx}']
-            attention_mask = attention_mask_dict[f'attention_mask_{dataset_idx}']
-
-            merged_logits = merged_model(input_ids=input_ids, attention_mask=attention_mask).logits
-            merged_logits_dict[f'merged_logits_{dataset_idx}'] = merged_logits
+
+        # Prefetch every input tensor up front with non-blocking copies so the H2D
+        # transfers (the dataloader pins its batches) overlap with the merged-model
+        # forward instead of blocking inside the loss loops.
+        inputs = {key: value.to(device, non_blocking=True) if torch.is_tensor(value) else value
+                  for key, value in inputs.items()}
+
+        # Gather the per-dataset inputs into integer-indexed lists (0-based) instead of
+        # string-keyed dicts, so the hot loop below does no string formatting or hashing
+        num_datasets = sum(1 for key in inputs.keys() if key.startswith('input_ids_'))
+        input_ids_list = [inputs[f'input_ids_{i}'] for i in range(1, num_datasets + 1)]
+        attention_mask_list = [inputs[f'attention_mask_{i}'] for i in range(1, num_datasets + 1)]
+        if not self.generate_logits_on_fly:
+            topk_logits_list = [inputs[f'topk_logits_model_{i}'] for i in range(1, num_datasets + 1)]
+            topk_indices_list = [inputs[f'topk_indices_model_{i}'] for i in range(1, num_datasets + 1)]
+
+        # Compute logits for the merged model with a single packed forward instead of one
+        # forward per input: pad every input to the longest sequence in the group,
+        # concatenate along the batch dimension, and split the logits back afterwards.
+        batch_sizes = [input_ids.size(0) for input_ids in input_ids_list]
+        max_seq_len = max(input_ids.size(1) for input_ids in input_ids_list)
+
+        packed_input_ids = torch.cat([
+            F.pad(input_ids, (0, max_seq_len - input_ids.size(1))) for input_ids in input_ids_list
+        ], dim=0)
+        packed_attention_mask = torch.cat([
+            F.pad(attention_mask, (0, max_seq_len - attention_mask.size(1))) for attention_mask in attention_mask_list
+        ], dim=0)
+
+        packed_logits = merged_model(input_ids=packed_input_ids, attention_mask=packed_attention_mask).logits
+
+        merged_logits_list = [logits_chunk[:, :input_ids.size(1)]
+                              for input_ids, logits_chunk in zip(input_ids_list, packed_logits.split(batch_sizes, dim=0))]
 
         # Compute logits for each individual model with the respective dataset if generate_logits_on_fly is True
         if self.generate_logits_on_fly:
-            individual_logits_dict = {}
-            
+            individual_logits_list = []
+
             # we do not compute logits for the base model
             for model_index in range(num_datasets):
                 # set the model index for the merged model to get correct logits from individual models.
                 set_model_index(merged_model, index=model_index)
-                input_ids = input_ids_dict[f'input_ids_{model_index + 1}']
-                attention_mask = attention_mask_dict[f'attention_mask_{model_index + 1}']
                 with torch.no_grad():
-                    model_logits = merged_model(input_ids=input_ids.cpu(), attention_mask=attention_mask.cpu()).logits
-                individual_logits_dict[model_index] = model_logits.to(device)
-            
+                    model_logits = merged_model(input_ids=input_ids_list[model_index].cpu(),
+                                                attention_mask=attention_mask_list[model_index].cpu()).logits
+                individual_logits_list.append(model_logits.to(device))
+
             # Reset model_index to None after computing logits for individual models
             set_model_index(merged_model, index=None)  # Reset model_index to None for merged model computations
-   
-    
+
+
         total_loss = 0.0
         all_loss_logs = {}
 
         # Compute KL divergence loss between the merged model's logits and each corresponding top-K logits
-        for dataset_idx in range(1, num_datasets + 1):
-            merged_logits = merged_logits_dict[f'merged_logits_{dataset_idx}']
-            attention_mask = attention_mask_dict[f'attention_mask_{dataset_idx}']
-            non_padded_tokens = attention_mask.sum().item()
+        for dataset_idx in range(num_datasets):
+            merged_logits = merged_logits_list[dataset_idx]
+            attention_mask = attention_mask_list[dataset_idx]
+            non_padded_tokens = attention_mask.sum()
 
+            kl_override = None
             if self.generate_logits_on_fly:
-                individual_logits = individual_logits_dict[dataset_idx - 1]
+                individual_logits = individual_logits_list[dataset_idx]
             else:
-                individual_logits = inputs[f'topk_logits_model_{dataset_idx}'].to(device)
-                topk_indices = inputs[f'topk_indices_model_{dataset_idx}'].to(device)
+                individual_logits = topk_logits_list[dataset_idx]
+                # The indices are shipped as int32 to halve the H2D transfer; widen to the
+                # int64 that gather requires only after the copy, on the device
+                topk_indices = topk_indices_list[dataset_idx].long()
+                if self.use_full_normalizer_topk_kl and (self.loss_fns['kl'] or self.report_all_metrics):
+                    # Proper top-K distillation: normalize the merged distribution over the
+                    # full vocabulary (one logsumexp) instead of softmaxing the K slice;
+                    # padding is masked per position inside the op, not by zeroing logits
+                    kl_override = topk_kl_divergence_loss(merged_logits,
+                                                          individual_logits,
+                                                          topk_indices,
+                                                          attention_mask,
+                                                          non_padded_tokens,
+                                                          temperature=self.temperature)
                 merged_logits = torch.gather(merged_logits, dim=-1, index=topk_indices)
-            
-            loss, loss_logs = self.compute_individual_logit_losses(merged_logits, 
-                                                                   individual_logits, 
-                                                                   attention_mask, 
-                                                                   non_padded_tokens, 
-                                                                   dataset_idx)
+
+            # Keep the 1-based id for the metric names so the logs stay stable
+            loss, loss_logs = self.compute_individual_logit_losses(merged_logits,
+                                                                   individual_logits,
+                                                                   attention_mask,
+                                                                   non_padded_tokens,
+                                                                   dataset_idx + 1,
+                                                                   kl_override=kl_override)
             total_loss += loss
             all_loss_logs.update(loss_logs)
 
-        # Compute similarity loss and L2 regularization for merging coefficients
+        # Compute similarity loss and L2 regularization for merging coefficients.
+        # Cache the DAM modules on first use instead of walking the thousands of modules
+        # in merged_model every step, and accumulate each regularizer with a single
+        # stacked reduction instead of per-module scalar additions. The mergers are
+        # already co-located with the model, so no .to(device) moves are needed.
+        if self._dam_modules is None:
+            self._dam_modules = [module for module in merged_model.modules()
+                                 if isinstance(module, (DAMLinearLayer, DAMEmbeddingLayer, DAMRMSNorm))]
+
         similarity_loss = torch.tensor(0.0, device=device)
         l1_l2_reg = torch.tensor(0.0, device=device)
         overlap_loss = torch.tensor(0.0, device=device)
         weighted_overlap_loss = torch.tensor(0.0, device=device)
-        for module in merged_model.modules():
-            if hasattr(module, 'compute_mergers_similarity') and (self.loss_fns['similarity'] or self.report_all_metrics):
-                similarity_loss += module.compute_mergers_similarity(self.lambda_coef_similarity).to(similarity_loss.device)
-            if hasattr(module, 'compute_mergers_L1_L2_reg') and (self.loss_fns['l1_l2_reg'] or self.report_all_metrics):
-                l1_l2_reg += module.compute_mergers_L1_L2_reg(
-                    lambda_coef_l1=self.lambda_coef_l1, 
-                    lambda_coef_l2=self.lambda_coef_l2
-                ).to(l1_l2_reg.device)
-            if hasattr(module, 'compute_mergers_overlap') and (self.loss_fns['overlap'] or self.report_all_metrics):
-                overlap_loss += module.compute_mergers_overlap(lambda_coef_overlap=self.lambda_coef_overlap).to(similarity_loss.device)
-            if hasattr(module, 'compute_weighted_overlap') and (self.loss_fns['weighted_overlap'] or self.report_all_metrics):
-                weighted_overlap_loss += module.compute_weighted_overlap(lambda_coef_overlap=self.lambda_coef_overlap).to(similarity_loss.device)
+        if self._dam_modules:
+            if self.loss_fns['similarity'] or self.report_all_metrics:
+                similarity_loss = torch.stack([module.compute_mergers_similarity(self.lambda_coef_similarity)
+                                               for module in self._dam_modules]).sum()
+            if self.loss_fns['l1_l2_reg'] or self.report_all_metrics:
+                l1_l2_reg = torch.stack([module.compute_mergers_L1_L2_reg(lambda_coef_l1=self.lambda_coef_l1,
+                                                                          lambda_coef_l2=self.lambda_coef_l2)
+                                         for module in self._dam_modules]).sum()
+            if self.loss_fns['overlap'] or self.report_all_metrics:
+                overlap_loss = torch.stack([module.compute_mergers_overlap(lambda_coef_overlap=self.lambda_coef_overlap)
+                                            for module in self._dam_modules]).sum()
+            if self.loss_fns['weighted_overlap'] or self.report_all_metrics:
+                weighted_overlap_loss = torch.stack([module.compute_weighted_overlap(lambda_coef_overlap=self.lambda_coef_overlap)
+                                                     for module in self._dam_modules]).sum()
 
         if self.loss_fns['similarity']:
             total_loss += similarity_loss 
@@ -236,50 +377,59 @@ class DAMTrainer(Trainer):
     
     def save_model(self, output_dir=None):
         """
-        Save the model and tokenizer to the specified directory.
+        Save the merged model and tokenizer to the specified directory.
+
+        Rather than loading a second copy of the base model and rewriting its
+        parameters, the state dict is streamed directly: merged weights are
+        computed from the DAM layers one at a time and all remaining tensors
+        are copied through, so peak host memory stays at a single model.
         """
         if output_dir is None:
             output_dir = self.args.output_dir
+        os.makedirs(output_dir, exist_ok=True)
 
-        # Initialize a new model with the same architecture as the base model
-        new_model = AutoModelForCausalLM.from_pretrained(self.base_model_path, torch_dtype=torch.bfloat16)
-        
-        tensors = {}
-        
-        # Iterate through all modules and update weights for DAMLinearLayers
-        for name, module in tqdm(self.model.named_modules(), desc="Merging layers", total=len(list(self.model.named_modules()))):
-            if isinstance(module, (DAMLinearLayer, DAMEmbeddingLayer, DAMRMSNorm)):
-                corresponding_module = glom(new_model, name)
-                # Get the merged weight and bias
-                
-                if isinstance(module, DAMLinearLayer):
-                    merged_weight = module.get_dam_weight().to(corresponding_module.weight.device)
-                if isinstance(module, DAMEmbeddingLayer):
-                    merged_weight = module.get_dam_embedding().to(corresponding_module.weight.device)
-                if isinstance(module, DAMRMSNorm):
-                    merged_weight = module.get_dam_weight().to(corresponding_module.weight.device)
-                    
-                for i, merger in enumerate(module.mergers):
-                    tensors[f"{name}.mergers.{i}"] = merger
-
-
-                merged_bias = None
-                
-                if hasattr(module, 'get_dam_bias'):
-                    merged_bias = module.get_dam_bias()
-                    if merged_bias is not None:
-                        for i, bias in enumerate(module.biases):
-                            tensors[f"{name}.biases.{i}"] = bias
-                        merged_bias = merged_bias.to(corresponding_module.bias.device)
-
-                # Update the weights and bias of the corresponding layer in the new model
-                corresponding_module.weight.data = merged_weight
-                if merged_bias is not None:
-                    corresponding_module.bias.data = merged_bias
+        # Collect the DAM layers by name so their stacked per-model tensors can be
+        # replaced with merged weights and skipped during the copy-through below
+        dam_modules = {name: module for name, module in self.model.named_modules()
+                       if isinstance(module, (DAMLinearLayer, DAMEmbeddingLayer, DAMRMSNorm))}
+
+        state_dict = {}
+        merger_tensors = {}
 
-        # Save the new model
-        save_file(tensors, os.path.join(output_dir, f"mergers.safetensors"))
+        for name, module in tqdm(dam_modules.items(), desc="Merging layers"):
+            # Compute the merged weight for the layer
+            if isinstance(module, DAMEmbeddingLayer):
+                merged_weight = module.get_dam_embedding()
+            else:
+                merged_weight = module.get_dam_weight()
+            state_dict[f"{name}.weight"] = merged_weight.to(torch.bfloat16).cpu()
 
-        new_model.save_pretrained(output_dir)
+            merger_tensors[f"{name}.mergers"] = module.mergers.data.cpu()
+
+            if hasattr(module, 'get_dam_bias'):
+                merged_bias = module.get_dam_bias()
+                if merged_bias is not None:
+                    merger_tensors[f"{name}.biases"] = module.biases.data.cpu()
+                    state_dict[f"{name}.bias"] = merged_bias.to(torch.bfloat16).cpu()
+
+        # Copy through every tensor that does not belong to a DAM layer (the DAM layers'
+        # parameters and buffers are direct attributes, so the owning module name is
+        # simply the key minus its final component)
+        for key, value in self.model.state_dict().items():
+            if key.rsplit('.', 1)[0] in dam_modules:
+                continue
+            # Only floating-point tensors get the bf16 cast; integer or bool buffers
+            # must keep their dtype
+            if value.is_floating_point():
+                value = value.to(torch.bfloat16)
+            state_dict[key] = value.cpu().clone()
+
+        # Save the merged weights and the merging coefficients
+        save_file(state_dict, os.path.join(output_dir, "model.safetensors"), metadata={"format": "pt"})
+        save_file(merger_tensors, os.path.join(output_dir, "mergers.safetensors"))
+
+        # Save the base model's config alongside so the result loads as a plain causal LM
+        config = AutoConfig.from_pretrained(self.base_model_path)
+        config.save_pretrained(output_dir)
         self.tokenizer.save_pretrained(output_dir)
-        print(f"Merged model saved successfully at {output_dir}!")
\ No newline at end of file
+        print(f"Merged model saved successfully at {output_dir}!")
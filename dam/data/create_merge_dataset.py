@@ -1,7 +1,7 @@
 import os
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
-from datasets import Dataset, load_from_disk
+from datasets import Dataset, Sequence, Value, load_from_disk
 from data_setup import setup_datasets_and_templates  # Assuming this function is in data_setup.py
 from data_preprocessing import preprocess_data  # Assuming this function is in data_preprocessing.py
 
@@ -67,13 +67,17 @@ def compute_and_save_topk_logits(models_dict, tokenized_dataset, device, batch_s
                     topk_logits, topk_indices = torch.topk(logits, top_k, dim=-1)  # Get top-K logits and their indices
 
                 # Convert the top-K logits and indices to lists and add to the respective lists
-                topk_logits_list.extend(topk_logits.cpu().numpy().tolist())
+                topk_logits_list.extend(topk_logits.float().cpu().numpy().tolist())
                 topk_indices_list.extend(topk_indices.cpu().numpy().tolist())
 
         if compute_logits:
-            # Add the top-K logits and indices as new columns in the dataset
+            # Add the top-K logits and indices as new columns in the dataset, stored with
+            # compact dtypes (fp16 logits, int32 indices) so the tensors shipped to the
+            # trainer are half the size; gather's int64 requirement is handled on the GPU
             tokenized_dataset = tokenized_dataset.add_column(f'topk_logits_model_{idx}', topk_logits_list)
             tokenized_dataset = tokenized_dataset.add_column(f'topk_indices_model_{idx}', topk_indices_list)
+            tokenized_dataset = tokenized_dataset.cast_column(f'topk_logits_model_{idx}', Sequence(Sequence(Value('float16'))))
+            tokenized_dataset = tokenized_dataset.cast_column(f'topk_indices_model_{idx}', Sequence(Sequence(Value('int32'))))
 
     return tokenized_dataset
 
@@ -110,16 +110,13 @@ def merge_models(base_model_id,
             num_models=len(models),
             eps=modules[0].variance_epsilon,
             dtype=modules[0].weight.dtype,
+            device=device,  # Allocate directly on the target device
             non_linearity=non_linearity,  # Set non_linearity based on user input
             use_random_init=norm_merge_random,  # Pass random_init based on argument
-            use_in_merging=merge_layernorms  # Pass use_in_merging to the class
-        ).to(device)
+            use_in_merging=merge_layernorms,  # Pass use_in_merging to the class
+            initial_weights=[module.weight.data for module in modules]  # Initialize straight from the models
+        )
 
-        # Loop over each module (i.e., norm layer) from the models being merged
-        for i, module in enumerate(modules):
-            # Assign the weights from the current model's layer to the corresponding slot in DAMLayerNorm
-            dam_layernorm.weights[i].data = module.weight.data
-                
         # Create an assignment operation to replace the original norm layer with the merged DAMRMSNorm
         assign = Assign(m, dam_layernorm)
         
@@ -135,13 +132,12 @@ def merge_models(base_model_id,
         embedding_dim=modules[0].embedding_dim,
         num_models=len(models),
         dtype=modules[0].weight.dtype,
+        device=device,  # Allocate directly on the target device
         non_linearity=non_linearity,  # Set non_linearity based on user input
         use_random_init=embedding_merge_random,  # Pass random_init based on argument
-        use_in_merging=merge_embedding_layers  # Pass use_in_merging to the class
-    ).to(device)
-
-    for i, module in enumerate(tqdm(modules, desc="Processing embedding layers")):
-        dam_embedding_layer.embeddings[i].data = module.weight.data  # Corrected assignment
+        use_in_merging=merge_embedding_layers,  # Pass use_in_merging to the class
+        initial_embeddings=[module.weight.data for module in modules]  # Initialize straight from the models
+    )
 
     assign = Assign(embedding_module[0], dam_embedding_layer)
     glom(merged_model, assign)
@@ -169,21 +165,19 @@ def merge_models(base_model_id,
             num_models=len(models),
             bias=modules[0].bias is not None,
             dtype=modules[0].weight.dtype,
+            device=device,  # Allocate directly on the target device
             non_linearity=non_linearity,  # Set non_linearity based on user input
             use_random_init=linear_merge_random,  # Pass random_init based on argument
-            use_in_merging=True  # Always set use_in_merging to True for linear layers
-        ).to(device)
+            use_in_merging=True,  # Always set use_in_merging to True for linear layers
+            initial_weights=[module.weight.data for module in modules]  # Initialize straight from the models
+        )
 
 
-        # Loop over each module (i.e., linear layer) from the models being merged
+        # If the layers have a bias, assign the bias from each model's layer to the corresponding slot
         for i, module in enumerate(modules):
-            # Assign the weights from the current model's layer to the corresponding slot in DAMLinearLayer
-            dam_linearlayer.weights[i].data = module.weight.data
-            
-            # If the layer has a bias, assign the bias from the current model's layer to the corresponding slot
             if module.bias is not None:
-                dam_linearlayer.biases[i].data = module.bias.data
-        
+                dam_linearlayer.biases.data[i] = module.bias.data
+
         base_weight = glom(merged_model, m).weight.data
         task_vectors = [module.weight.data - base_weight for module in modules]
         similarity_weightings = calculate_similarity_weightings(task_vectors)
@@ -6,7 +6,7 @@ from modeling.mistral.modeling import MergedMistralForCausalLM
 from modeling.llama3.config import MergedLlamaConfig
 from modeling.llama3.modeling import MergedLlamaForCausalLM
 from glom import glom, Assign
-from modeling.dam import DAMLinearLayer
+from modeling.dam import DAMBaseLayer, DAMLinearLayer
 from utils import find_linear_layers, find_embedding_layers
 
 AutoConfig.register("mergedmistral", MergedMistralConfig)
@@ -43,14 +43,19 @@ def print_trainable_parameters(model):
 
 
 def freeze_except_mergers(model):
-    # Loop through all parameters in the model
-    for name, param in model.named_parameters():
-        # Freeze all parameters by setting requires_grad to False
+    # Freeze all parameters in the model
+    for param in model.parameters():
         param.requires_grad = False
-        
-        # Unfreeze merging weights and biases
-        if "mergers" in name or "bias_mergers" in name:
-            param.requires_grad = True
+
+    # Unfreeze the merging coefficients directly on the DAM layers. Each layer stores
+    # its mergers (and bias mergers) as a single stacked Parameter, so DDP sees one or
+    # two gradient tensors per layer instead of one per merged model, which lets it
+    # pack them into far larger all-reduce buckets.
+    for module in model.modules():
+        if isinstance(module, DAMBaseLayer):
+            module.mergers.requires_grad_(True)
+            if hasattr(module, 'bias_mergers'):
+                module.bias_mergers.requires_grad_(True)
     
 def prepare_model(model_name, cache_dir):
     print(f"Loading model from {model_name} with cache dir {cache_dir}")
@@ -0,0 +1,99 @@
+import json
+import re
+
+import torch
+
+from transformers.utils import (
+    SAFE_WEIGHTS_INDEX_NAME,
+    SAFE_WEIGHTS_NAME,
+    WEIGHTS_INDEX_NAME,
+    WEIGHTS_NAME,
+    cached_file,
+)
+
+# Keys used by checkpoints saved before the per-model ParameterLists were collapsed
+# into stacked parameters: every DAM tensor was stored under an indexed key such as
+# "model.layers.0.mlp.gate_proj.weights.2" instead of a single stacked "weights"
+_LEGACY_KEY_PATTERN = re.compile(
+    r"^(?P<stacked>.*\.(?:weights|biases|mergers|bias_mergers|embeddings))\.(?P<index>\d+)$"
+)
+
+
+def _resolve_checkpoint_files(pretrained_model_name_or_path, **hub_kwargs):
+    # Resolve the checkpoint to its weight files (single or sharded, safetensors
+    # preferred) the same way from_pretrained does, for both local paths and the hub
+    for weights_name, index_name in (
+        (SAFE_WEIGHTS_NAME, SAFE_WEIGHTS_INDEX_NAME),
+        (WEIGHTS_NAME, WEIGHTS_INDEX_NAME),
+    ):
+        single_file = cached_file(
+            pretrained_model_name_or_path, weights_name,
+            _raise_exceptions_for_missing_entries=False, **hub_kwargs,
+        )
+        if single_file is not None:
+            return [single_file]
+        index_file = cached_file(
+            pretrained_model_name_or_path, index_name,
+            _raise_exceptions_for_missing_entries=False, **hub_kwargs,
+        )
+        if index_file is not None:
+            with open(index_file) as f:
+                shard_names = sorted(set(json.load(f)["weight_map"].values()))
+            return [
+                cached_file(pretrained_model_name_or_path, shard_name, **hub_kwargs)
+                for shard_name in shard_names
+            ]
+    return []
+
+
+def _iter_legacy_tensors(checkpoint_file):
+    # Safetensors shards can be read key by key, so only the legacy tensors are pulled
+    # off disk; torch .bin checkpoints have to be deserialized in full
+    if checkpoint_file.endswith(".safetensors"):
+        from safetensors import safe_open
+
+        with safe_open(checkpoint_file, framework="pt") as f:
+            for key in f.keys():
+                if _LEGACY_KEY_PATTERN.match(key):
+                    yield key, f.get_tensor(key)
+    else:
+        state_dict = torch.load(checkpoint_file, map_location="cpu", weights_only=True)
+        for key, value in state_dict.items():
+            if _LEGACY_KEY_PATTERN.match(key):
+                yield key, value
+
+
+def load_legacy_dam_tensors(model, pretrained_model_name_or_path, **hub_kwargs):
+    """Stack legacy per-model DAM tensors from a checkpoint into `model`.
+
+    `DAMBaseLayer._load_from_state_dict` remaps the indexed keys for plain
+    `load_state_dict` calls, but `from_pretrained` with a `device_map` (and recent
+    transformers versions in general) loads through the low-memory meta path, which
+    assigns checkpoint tensors key by key and never runs the module-level hooks: the
+    indexed tensors land in `unexpected_keys` while the stacked parameters keep
+    whatever they were initialized with. Since a key-rename hook cannot combine N
+    checkpoint tensors into one, this re-reads the indexed tensors straight from the
+    checkpoint files after the model is materialized and copies the stacked result
+    into the parameters. Checkpoints already saved in the stacked layout contain no
+    indexed keys, so this is a no-op for them.
+    """
+    if pretrained_model_name_or_path is None:
+        return
+
+    legacy_tensors = {}
+    for checkpoint_file in _resolve_checkpoint_files(pretrained_model_name_or_path, **hub_kwargs):
+        for key, value in _iter_legacy_tensors(checkpoint_file):
+            match = _LEGACY_KEY_PATTERN.match(key)
+            legacy_tensors.setdefault(match["stacked"], {})[int(match["index"])] = value
+
+    if not legacy_tensors:
+        return
+
+    parameters = dict(model.named_parameters())
+    for stacked_key, pieces in legacy_tensors.items():
+        parameter = parameters.get(stacked_key)
+        if parameter is None or parameter.size(0) != len(pieces):
+            continue
+        stacked = torch.stack([pieces[index] for index in sorted(pieces)])
+        with torch.no_grad():
+            parameter.copy_(stacked.to(device=parameter.device, dtype=parameter.dtype))
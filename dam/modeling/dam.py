@@ -3,7 +3,7 @@ from torch import nn, Tensor
 import torch.nn.functional as F
 from typing import Optional, Union
 from torch.nn.parameter import Parameter
-import itertools
+from .kernels import dam_fused_linear
 
 # Base class for a layer that will merge weights from multiple models
 class DAMBaseLayer(nn.Module):
@@ -14,6 +14,7 @@ class DAMBaseLayer(nn.Module):
         num_models=3,
         init_merger_values=[],
         dtype=None,
+        device=None,  # Device to allocate the parameters on
         non_linearity: str = 'None',  # Option to apply non-linearity
         model_index: Optional[int] = None,
         is_embedding: bool = False,  # Flag to indicate if this is an embedding layer
@@ -26,8 +27,10 @@ class DAMBaseLayer(nn.Module):
         self.num_models = num_models
         self.model_index = model_index
 
-        # Store the non-linearity to be applied on the merging coefficients
+        # Store the non-linearity to be applied on the merging coefficients and bind the
+        # corresponding function once, since it is fixed for the lifetime of the layer
         self.non_linearity = non_linearity
+        self._nl_fn = {'tanh': torch.tanh, 'sigmoid': torch.sigmoid, 'relu': torch.relu}.get(non_linearity, lambda tensor: tensor)
 
         # If use_random_init is True, initialize the merger values with random numbers normalized between 0 and 1
         if use_random_init:
@@ -39,110 +42,128 @@ class DAMBaseLayer(nn.Module):
         # Store the initial merger values
         self.init_merger_values = init_merger_values
 
-        # Initialize the list of merging coefficients for each model's layer
-        self.mergers = nn.ParameterList([Parameter(
-            torch.ones(in_features, dtype=dtype) * init_merger_values[i],
+        # Initialize the merging coefficients for all models as a single stacked (num_models, in_features) parameter
+        # so the weighted sum over models can be computed with one kernel instead of num_models separate ones
+        self.mergers = Parameter(
+            torch.ones(num_models, in_features, dtype=dtype, device=device) * torch.tensor(init_merger_values, dtype=dtype, device=device).unsqueeze(-1),
             requires_grad=use_in_merging  # Set requires_grad based on merging
-        ) for i in range(num_models)])
-        
-        self.register_buffer('similarity_weightings', torch.zeros(3, in_features))#torch.zeros((in_features * (in_features - 1)) // 2))
+        )
+
+        self.register_buffer('similarity_weightings', torch.zeros(3, in_features, device=device))#torch.zeros((in_features * (in_features - 1)) // 2))
+
+        # Cache for the merged tensors used while the module is in eval mode, where the
+        # mergers are frozen and the merge does not need to be rebuilt every forward
+        self._merged_cache = None
+
+    def train(self, mode: bool = True):
+        # Invalidate the eval-time cache when switching back to training, since the
+        # optimizer updates the mergers between forwards
+        if mode:
+            self._merged_cache = None
+        return super().train(mode)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # Remap checkpoints saved with the pre-stacked layout, where each per-model
+        # tensor was a separate ParameterList entry (e.g. "mergers.0" ... "mergers.N"),
+        # into the stacked parameters so older merged models keep loading correctly.
+        # This only covers direct load_state_dict calls; from_pretrained's low-memory
+        # path bypasses it and is handled by checkpoint_compat.load_legacy_dam_tensors
+        for name in self._parameters:
+            stacked_key = prefix + name
+            if stacked_key in state_dict:
+                continue
+            legacy_keys = [f"{stacked_key}.{i}" for i in range(self.num_models)]
+            if all(key in state_dict for key in legacy_keys):
+                state_dict[stacked_key] = torch.stack([state_dict.pop(key) for key in legacy_keys])
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
 
     def compute_mergers_overlap(self, lambda_coef_overlap=0.000001):
-        # Check if any merger requires gradient
-        if all(not merger.requires_grad for merger in self.mergers):
-            device = self.mergers[0].device
-            return  torch.tensor(0.0, device=device)
-        
-        # Initialize similarity loss
-        overlap_loss = 0.0
-        
-        # Create all possible pairs of merging coefficients
-        combinations = list(itertools.combinations([p for p in self.mergers], 2))
-        num_combinations = len(combinations)
-    
-        if num_combinations > 0:
-            overlaps = []
-            for merger_a, merger_b in combinations:
-                overlap = torch.sum(torch.min(torch.abs(merger_a),torch.abs(merger_b)), dim=0)
-
-                overlaps.append(overlap)
-                
-            # Average the overlaps and multiply by the provided coefficient
-            overlap_loss = torch.mean(torch.stack(overlaps))
-            overlap_loss *= lambda_coef_overlap
-    
-        return overlap_loss
+        # Check if the mergers require gradient
+        if not self.mergers.requires_grad:
+            return torch.tensor(0.0, device=self.mergers.device)
+
+        num_models = self.mergers.size(0)
+        if num_models < 2:
+            return torch.tensor(0.0, device=self.mergers.device)
+
+        # Compute min(|c_a|, |c_b|) for every pair of mergers at once by indexing the
+        # stacked tensor with the upper-triangular pair indices, then reduce in one go
+        # (in fp32 so the bf16 mergers don't lose precision in the reduction)
+        abs_mergers = self.mergers.float().abs()
+        row_idx, col_idx = torch.triu_indices(num_models, num_models, offset=1)
+        overlaps = torch.minimum(abs_mergers[row_idx], abs_mergers[col_idx]).sum(dim=1)
+
+        # Average the overlaps and multiply by the provided coefficient
+        return overlaps.mean() * lambda_coef_overlap
 
     # Method to compute the similarity between merging coefficients
     def compute_mergers_similarity(self, lambda_coef=None):
-        # Check if any merger requires gradient
-        if lambda_coef is None or all(not merger.requires_grad for merger in self.mergers):
-            device = self.mergers[0].device
-            return  torch.tensor(0.0, device=device)
-    
-        # Initialize similarity loss
-        similarity_loss = 0.0
-        
-        # Create all possible pairs of merging coefficients
-        combinations = list(itertools.combinations([p for p in self.mergers], 2))
-        num_combinations = len(combinations)
-    
-        if num_combinations > 0:
-            similarities = []
-            for merger_a, merger_b in combinations:
-                # Calculate cosine similarity between each pair of merging coefficients
-                similarity = F.cosine_similarity(merger_a, merger_b, dim=0)
-                similarities.append(similarity)
-                
-            # Average the similarities and multiply by the provided coefficient
-            similarity_loss = torch.mean(torch.stack(similarities))
-            similarity_loss *= lambda_coef
-    
-        return similarity_loss
+        # Check if the mergers require gradient
+        if lambda_coef is None or not self.mergers.requires_grad:
+            return torch.tensor(0.0, device=self.mergers.device)
+
+        num_models = self.mergers.size(0)
+        if num_models < 2:
+            return torch.tensor(0.0, device=self.mergers.device)
+
+        # Run the reduction in fp32 with autocast disabled: the mergers train in bf16,
+        # whose short mantissa drifts when thousands of per-layer scalars are summed
+        with torch.autocast(device_type=self.mergers.device.type, enabled=False):
+            # Normalize the mergers once and compute all pairwise cosine similarities with a single matmul
+            normalized = F.normalize(self.mergers.float(), dim=1)
+            similarity_matrix = normalized @ normalized.T
+
+            # Average the upper-triangular entries (each pair counted once) and multiply by the provided coefficient
+            row_idx, col_idx = torch.triu_indices(num_models, num_models, offset=1)
+            return similarity_matrix[row_idx, col_idx].mean() * lambda_coef
     
     def compute_weighted_overlap(self, lambda_coef_overlap=1):
-        merger_combinations = list(itertools.combinations([p for p in self.mergers], 2))
-        merger_tensor = torch.stack([torch.stack(pair) for pair in merger_combinations])
+        num_models = self.mergers.size(0)
 
-        overlap = torch.min(torch.abs(merger_tensor), dim=1).values
+        # Gather all pairs of mergers from the stacked tensor instead of building a
+        # Python list of combinations, then weight and reduce in a single pass
+        # (in fp32 so the bf16 mergers don't lose precision in the reduction)
+        abs_mergers = self.mergers.float().abs()
+        row_idx, col_idx = torch.triu_indices(num_models, num_models, offset=1)
+        overlap = torch.minimum(abs_mergers[row_idx], abs_mergers[col_idx])
         weighted_overlap = overlap * self.similarity_weightings
-        
+
         overlaps = torch.sum(weighted_overlap, dim=1)
-        
+
         result = torch.mean(overlaps)
         return result * lambda_coef_overlap
 
     # Method to compute L1 and L2 regularization on the merging coefficients
     def compute_mergers_L1_L2_reg(self, lambda_coef_l1=None, lambda_coef_l2=None):
-        # Check if any merger requires gradient
-        if all(not merger.requires_grad for merger in self.mergers):
-            return torch.tensor(0.0, device=self.mergers[0].device)
+        # Check if the mergers require gradient
+        if not self.mergers.requires_grad:
+            return torch.tensor(0.0, device=self.mergers.device)
 
-        device = self.mergers[0].device
+        device = self.mergers.device
         l1_reg = torch.tensor(0.0, device=device)
         l2_reg = torch.tensor(0.0, device=device)
 
-        # Calculate L1 norm for each merging coefficient in the ParameterList and sum them
+        # Accumulate the norms in fp32 so the bf16 mergers don't lose precision in the reduction
+        mergers = self.mergers.float()
+
+        # Calculate the summed L1 norm of the merging coefficients with a single kernel
         if lambda_coef_l1 is not None:
-            l1_reg += sum(merger.norm(1).to(device) for merger in self.mergers) * lambda_coef_l1
+            l1_reg = mergers.abs().sum() * lambda_coef_l1
 
-        # Calculate L2 norm for each merging coefficient in the ParameterList and sum them
+        # Calculate the per-model L2 norms of the merging coefficients and sum them with a single kernel
         if lambda_coef_l2 is not None:
-            l2_reg += sum(merger.norm(2).to(device) for merger in self.mergers) * lambda_coef_l2
+            l2_reg = mergers.norm(p=2, dim=1).sum() * lambda_coef_l2
 
         # Return the combined L1 and L2 regularization loss
         return l1_reg + l2_reg
 
     # Method to apply the specified non-linearity to the merging coefficients
     def apply_non_linearity(self, tensor):
-        if self.non_linearity == 'tanh':
-            return torch.tanh(tensor)
-        elif self.non_linearity == 'sigmoid':
-            return torch.sigmoid(tensor)
-        elif self.non_linearity == 'relu':
-            return torch.relu(tensor)
-        else:
-            return tensor  # If non_linearity is None or unsupported, return the tensor as is
+        # The function was resolved once in __init__; if non_linearity is None or
+        # unsupported this is the identity
+        return self._nl_fn(tensor)
 
 # Specialized class for a linear layer that uses the DAMBaseLayer
 class DAMLinearLayer(DAMBaseLayer):
@@ -154,10 +175,13 @@ class DAMLinearLayer(DAMBaseLayer):
         bias: bool=False,
         init_merger_values=[],
         dtype=None,
-        non_linearity: str = 'tanh',  # Option to apply non-linearity   
+        device=None,  # Device to allocate the parameters on
+        non_linearity: str = 'tanh',  # Option to apply non-linearity
         model_index: Optional[int] = None,
         use_random_init: bool = False,  # Flag to indicate if random initialization should be used
         use_in_merging: bool = True,  # Flag to indicate if this layer should be used in merging
+        fuse_forward: bool = True,  # Flag to fuse the merge into the matmul during training
+        initial_weights=None,  # Optional per-model weight tensors to initialize from
     ):
         super().__init__(
             in_features=in_features,
@@ -165,6 +189,7 @@ class DAMLinearLayer(DAMBaseLayer):
             num_models=num_models,
             init_merger_values=init_merger_values,
             dtype=dtype,
+            device=device,
             non_linearity=non_linearity,
             model_index=model_index,
             is_embedding=False,  # This is not an embedding layer
@@ -172,31 +197,40 @@ class DAMLinearLayer(DAMBaseLayer):
             use_in_merging=use_in_merging,  # Pass the flag to the base class
         )
 
-        # Initialize the list of weights for each model's layer
-        self.weights = nn.ParameterList([Parameter(
-            torch.zeros(out_features, in_features, dtype=dtype),
+        # Whether to avoid materializing the merged weight during training (see forward)
+        self.fuse_forward = fuse_forward
+
+        # Initialize the stacked (num_models, out_features, in_features) weights from the
+        # supplied per-model tensors when given; otherwise allocate uninitialized storage
+        # directly on the target device. The real weights always come from the source
+        # models, so there is no point zero-filling (and paying a memset for) a full-size
+        # tensor per model that is immediately overwritten.
+        if initial_weights is not None:
+            stacked_weights = torch.stack([weight.to(device=device, dtype=dtype) for weight in initial_weights])
+        else:
+            stacked_weights = torch.empty(num_models, out_features, in_features, dtype=dtype, device=device)
+        self.weights = Parameter(
+            stacked_weights,
             requires_grad=False  # Freeze weights
-        ) for i in range(num_models)])
+        )
 
-        # If the layer has a bias, initialize the list of biases and bias mergers for each model
+        # If the layer has a bias, initialize the stacked biases and bias mergers for all models
         if bias:
-            self.biases = nn.ParameterList([nn.Parameter(torch.zeros(out_features, dtype=dtype), requires_grad=False) for i in range(num_models)])
-            self.bias_mergers = nn.ParameterList([nn.Parameter(torch.ones(1, dtype=dtype), requires_grad=use_in_merging) for i in range(num_models)])
+            self.biases = Parameter(torch.zeros(num_models, out_features, dtype=dtype, device=device), requires_grad=False)
+            self.bias_mergers = Parameter(torch.ones(num_models, 1, dtype=dtype, device=device), requires_grad=use_in_merging)
 
     # Method to compute the combined weight for the merged layer
     def get_dam_weight(self):
-        device = self.mergers[0].device
-        constrained_mergers = [self.apply_non_linearity(merger) for merger in self.mergers] if self.non_linearity else self.mergers
-        # Sum the weighted contributions of each model's weight using the (possibly constrained) merging coefficients
-        return sum(merger.to(device) * weight.to(device) for merger, weight in zip(constrained_mergers, self.weights))
-    
+        constrained_mergers = self.apply_non_linearity(self.mergers)
+        # Contract the stacked weights against the (possibly constrained) merging coefficients in a single einsum
+        return torch.einsum('mi,moi->oi', constrained_mergers, self.weights)
+
     # Method to compute the combined bias for the merged layer (if bias is used)
     def get_dam_bias(self):
         if hasattr(self, 'biases'):
-            device = self.bias_mergers[0].device
-            constrained_bias_mergers = [self.apply_non_linearity(merger) for merger in self.bias_mergers] if self.non_linearity else self.bias_mergers
+            constrained_bias_mergers = self.apply_non_linearity(self.bias_mergers)
             # Sum the weighted contributions of each model's bias using the (possibly constrained) bias merging coefficients
-            return sum(merger.to(device) * bias.to(device) for merger, bias in zip(constrained_bias_mergers, self.biases))
+            return (constrained_bias_mergers * self.biases).sum(dim=0)
         return None
 
     # Forward pass through the DAMLinearLayer
@@ -206,11 +240,30 @@ class DAMLinearLayer(DAMBaseLayer):
             weight = self.weights[self.model_index].to(hidden_states.device)
             bias = self.biases[self.model_index].to(hidden_states.device) if hasattr(self, 'biases') else None
             return F.linear(hidden_states, weight=weight, bias=bias)
+        elif self.fuse_forward and self.training:
+            # Since the mergers act along in_features, x @ W^T = sum_m (x * nl(c_m)) @ w_m^T,
+            # so the merge can be distributed into the activations. dam_fused_linear applies
+            # the merge inside a tiled Triton matmul on CUDA (einsum elsewhere), so the full
+            # (out_features, in_features) merged weight is never materialized during training.
+            constrained_mergers = self.apply_non_linearity(self.mergers)
+            output = dam_fused_linear(hidden_states, self.weights, constrained_mergers)
+            bias = self.get_dam_bias()
+            return output if bias is None else output + bias
         else:
-            # Ensure the weights are on the same device as the input tensor
-            weight = self.get_dam_weight().to(hidden_states.device)
-            # Ensure the bias (if any) is on the same device as the input tensor
-            bias = self.get_dam_bias().to(hidden_states.device) if self.get_dam_bias() is not None else None
+            # In eval mode the mergers are frozen, so reuse the cached merged weight and
+            # bias instead of rebuilding the O(num_models * out * in) reduction every call
+            if not self.training and self._merged_cache is not None:
+                weight, bias = self._merged_cache
+            else:
+                weight = self.get_dam_weight()
+                bias = self.get_dam_bias()
+                if not self.training:
+                    self._merged_cache = (weight, bias)
+
+            # Ensure the weights and bias are on the same device as the input tensor
+            weight = weight.to(hidden_states.device)
+            if bias is not None:
+                bias = bias.to(hidden_states.device)
 
             # Perform the linear transformation using the merged weight and bias
             return F.linear(hidden_states, weight=weight, bias=bias)
@@ -224,11 +277,13 @@ class DAMEmbeddingLayer(DAMBaseLayer):
         num_models=3,
         init_merger_values=[],
         dtype=None,
+        device=None,  # Device to allocate the parameters on
         non_linearity: str = 'tanh',  # Option to apply non-linearity
         model_index: Optional[int] = None,
         padding_idx: Optional[int] = None,
         use_random_init: bool = False,  # Flag to indicate if random initialization should be used
         use_in_merging: bool = False,  # Flag to indicate if this layer should be used in merging
+        initial_embeddings=None,  # Optional per-model embedding tensors to initialize from
     ):
         super().__init__(
             in_features=embedding_dim,
@@ -236,6 +291,7 @@ class DAMEmbeddingLayer(DAMBaseLayer):
             num_models=num_models,
             init_merger_values=init_merger_values,
             dtype=dtype,
+            device=device,
             non_linearity=non_linearity,
             model_index=model_index,
             is_embedding=True,  # This is an embedding layer
@@ -243,18 +299,23 @@ class DAMEmbeddingLayer(DAMBaseLayer):
             use_in_merging=use_in_merging,  # Pass the flag to the base class
         )
 
-        # Initialize the list of embeddings for each model's layer as nn.Embedding
-        self.embeddings = nn.ParameterList([Parameter(
-            torch.zeros(num_embeddings, embedding_dim, dtype=dtype),
+        # Initialize the stacked (num_models, num_embeddings, embedding_dim) embeddings from
+        # the supplied per-model tensors when given, otherwise allocate uninitialized
+        # storage directly on the target device (the real embeddings come from the models)
+        if initial_embeddings is not None:
+            stacked_embeddings = torch.stack([embedding.to(device=device, dtype=dtype) for embedding in initial_embeddings])
+        else:
+            stacked_embeddings = torch.empty(num_models, num_embeddings, embedding_dim, dtype=dtype, device=device)
+        self.embeddings = Parameter(
+            stacked_embeddings,
             requires_grad=False  # Freeze embeddings
-        ) for i in range(num_models)])
+        )
 
     # Method to compute the combined embedding for the merged layer
     def get_dam_embedding(self):
-        device = self.mergers[0].device
-        constrained_mergers = [self.apply_non_linearity(merger) for merger in self.mergers] if self.non_linearity else self.mergers
-        # Sum the weighted contributions of each model's embedding using the (possibly constrained) merging coefficients
-        return sum(merger.to(device) * embedding.to(device) for merger, embedding in zip(constrained_mergers, self.embeddings))
+        constrained_mergers = self.apply_non_linearity(self.mergers)
+        # Contract the stacked embeddings against the (possibly constrained) merging coefficients in a single einsum
+        return torch.einsum('md,med->ed', constrained_mergers, self.embeddings)
 
     # Forward pass through the DAMEmbeddingLayer
     def forward(self, input_ids: torch.Tensor) -> torch.Tensor:
@@ -263,8 +324,16 @@ class DAMEmbeddingLayer(DAMBaseLayer):
             embedding = self.embeddings[self.model_index].to(input_ids.device)
             return F.embedding(input_ids, embedding)
         else:
+            # In eval mode the mergers are frozen, so reuse the cached merged embedding
+            if not self.training and self._merged_cache is not None:
+                embedding = self._merged_cache
+            else:
+                embedding = self.get_dam_embedding()
+                if not self.training:
+                    self._merged_cache = embedding
+
             # Ensure the embeddings are on the same device as the input tensor
-            embedding = self.get_dam_embedding().to(input_ids.device)
+            embedding = embedding.to(input_ids.device)
             # Perform the embedding lookup using the merged embedding
             return F.embedding(input_ids, embedding)
 
@@ -277,10 +346,12 @@ class DAMRMSNorm(DAMBaseLayer):
         eps: float = 1e-5,
         init_merger_values=[],
         dtype=None,
+        device=None,  # Device to allocate the parameters on
         non_linearity: str = 'tanh',  # Option to apply non-linearity
         model_index: Optional[int] = None,
         use_random_init: bool = False,  # Flag to indicate if random initialization should be used
         use_in_merging: bool = False,  # Flag to indicate if this layer should be used in merging
+        initial_weights=None,  # Optional per-model weight tensors to initialize from
     ):
         super().__init__(
             in_features=normalized_shape,
@@ -288,6 +359,7 @@ class DAMRMSNorm(DAMBaseLayer):
             num_models=num_models,
             init_merger_values=init_merger_values,
             dtype=dtype,
+            device=device,
             non_linearity=non_linearity,
             model_index=model_index,
             is_embedding=False,  # This is not an embedding layer
@@ -297,18 +369,22 @@ class DAMRMSNorm(DAMBaseLayer):
 
         self.eps = eps
 
-        # Initialize the list of weights for each model's layer normalization
-        self.weights = nn.ParameterList([Parameter(
-            torch.ones(normalized_shape, dtype=dtype),
+        # Initialize the stacked per-model layer normalization weights from the supplied
+        # tensors when given, otherwise fall back to ones on the target device
+        if initial_weights is not None:
+            stacked_weights = torch.stack([weight.to(device=device, dtype=dtype) for weight in initial_weights])
+        else:
+            stacked_weights = torch.ones(num_models, normalized_shape, dtype=dtype, device=device)
+        self.weights = Parameter(
+            stacked_weights,
             requires_grad=False  # Freeze weights
-        ) for i in range(num_models)])
+        )
 
     # Method to compute the combined weight for the merged layer normalization
     def get_dam_weight(self):
-        device = self.mergers[0].device
-        constrained_mergers = [self.apply_non_linearity(merger) for merger in self.mergers] if self.non_linearity else self.mergers
+        constrained_mergers = self.apply_non_linearity(self.mergers)
         # Sum the weighted contributions of each model's weight using the (possibly constrained) merging coefficients
-        return sum(merger.to(device) * weight.to(device) for merger, weight in zip(constrained_mergers, self.weights))
+        return (constrained_mergers * self.weights).sum(dim=0)
 
     # Forward pass through the DAMLayerNorm
     def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
@@ -321,8 +397,16 @@ class DAMRMSNorm(DAMBaseLayer):
             hidden_states = hidden_states * torch.rsqrt(variance + self.eps)
             return weight * hidden_states.to(input_dtype)
         else:
+            # In eval mode the mergers are frozen, so reuse the cached merged weight
+            if not self.training and self._merged_cache is not None:
+                weight = self._merged_cache
+            else:
+                weight = self.get_dam_weight()
+                if not self.training:
+                    self._merged_cache = weight
+
             # Ensure the weights are on the same device as the input tensor
-            weight = self.get_dam_weight().to(hidden_states.device)
+            weight = weight.to(hidden_states.device)
             input_dtype = hidden_states.dtype
             hidden_states = hidden_states.to(torch.float32)
             variance = hidden_states.pow(2).mean(-1, keepdim=True)
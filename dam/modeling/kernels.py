@@ -0,0 +1,129 @@
+import torch
+
+# Triton is optional: when it is missing (or the tensors are not on CUDA) the fused
+# linear falls back to a plain einsum that is numerically equivalent.
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+
+if triton is not None:
+    @triton.jit
+    def _dam_linear_fwd_kernel(
+        x_ptr, w_ptr, c_ptr, y_ptr,
+        B, OUT, IN, M,
+        stride_xb, stride_xi,
+        stride_wm, stride_wo, stride_wi,
+        stride_cm, stride_ci,
+        stride_yb, stride_yo,
+        BLOCK_B: tl.constexpr, BLOCK_O: tl.constexpr, BLOCK_I: tl.constexpr,
+    ):
+        # Each program computes one (BLOCK_B, BLOCK_O) tile of y = sum_m (x * c_m) @ w_m^T.
+        # The per-model merge is applied in registers while the tiles stream through, so
+        # the full merged (OUT, IN) weight is never written to global memory.
+        pid_b = tl.program_id(0)
+        pid_o = tl.program_id(1)
+
+        offs_b = pid_b * BLOCK_B + tl.arange(0, BLOCK_B)
+        offs_o = pid_o * BLOCK_O + tl.arange(0, BLOCK_O)
+        mask_b = offs_b < B
+        mask_o = offs_o < OUT
+
+        acc = tl.zeros((BLOCK_B, BLOCK_O), dtype=tl.float32)
+
+        for m in range(M):
+            for i_start in range(0, IN, BLOCK_I):
+                offs_i = i_start + tl.arange(0, BLOCK_I)
+                mask_i = offs_i < IN
+
+                # Load the activation tile once per (m, i) step and scale it by the
+                # constrained merging coefficients of model m
+                x_tile = tl.load(
+                    x_ptr + offs_b[:, None] * stride_xb + offs_i[None, :] * stride_xi,
+                    mask=mask_b[:, None] & mask_i[None, :], other=0.0,
+                )
+                c_tile = tl.load(
+                    c_ptr + m * stride_cm + offs_i * stride_ci,
+                    mask=mask_i, other=0.0,
+                )
+                w_tile = tl.load(
+                    w_ptr + m * stride_wm + offs_o[:, None] * stride_wo + offs_i[None, :] * stride_wi,
+                    mask=mask_o[:, None] & mask_i[None, :], other=0.0,
+                )
+
+                scaled = (x_tile * c_tile[None, :]).to(w_tile.dtype)
+                acc += tl.dot(scaled, tl.trans(w_tile))
+
+        tl.store(
+            y_ptr + offs_b[:, None] * stride_yb + offs_o[None, :] * stride_yo,
+            acc.to(y_ptr.dtype.element_ty),
+            mask=mask_b[:, None] & mask_o[None, :],
+        )
+
+
+def _dam_linear_reference(hidden_states, weights, constrained_mergers):
+    # Eager equivalent of the fused kernel: distribute the mergers into the
+    # activations and contract against the stacked weights in one einsum
+    scaled_states = hidden_states.unsqueeze(0) * constrained_mergers.view(
+        constrained_mergers.size(0), *([1] * (hidden_states.dim() - 1)), hidden_states.size(-1)
+    )
+    return torch.einsum('m...i,moi->...o', scaled_states, weights)
+
+
+class _DAMFusedLinear(torch.autograd.Function):
+    # Forward runs the Triton kernel; backward uses the analytic gradients
+    # grad_x = sum_m c_m * (grad_y @ w_m) and grad_c[m] = sum_b x * (grad_y @ w_m),
+    # which only touch activation-sized tensors
+    @staticmethod
+    def forward(ctx, hidden_states, weights, constrained_mergers):
+        orig_shape = hidden_states.shape
+        x = hidden_states.reshape(-1, orig_shape[-1]).contiguous()
+        num_models, out_features, in_features = weights.shape
+
+        output = torch.empty(x.size(0), out_features, device=x.device, dtype=x.dtype)
+
+        block_b, block_o, block_i = 16, 64, 64
+        grid = (triton.cdiv(x.size(0), block_b), triton.cdiv(out_features, block_o))
+        _dam_linear_fwd_kernel[grid](
+            x, weights, constrained_mergers, output,
+            x.size(0), out_features, in_features, num_models,
+            x.stride(0), x.stride(1),
+            weights.stride(0), weights.stride(1), weights.stride(2),
+            constrained_mergers.stride(0), constrained_mergers.stride(1),
+            output.stride(0), output.stride(1),
+            BLOCK_B=block_b, BLOCK_O=block_o, BLOCK_I=block_i,
+        )
+
+        ctx.save_for_backward(x, weights, constrained_mergers)
+        ctx.orig_shape = orig_shape
+        return output.reshape(*orig_shape[:-1], out_features)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, weights, constrained_mergers = ctx.saved_tensors
+        grad_y = grad_output.reshape(-1, grad_output.size(-1))
+
+        grad_hidden_states = None
+        grad_mergers = None
+
+        # Shared per-model term grad_y @ w_m, reused by both gradients
+        per_model = torch.einsum('bo,moi->mbi', grad_y, weights)
+        if ctx.needs_input_grad[0]:
+            grad_hidden_states = torch.einsum('mbi,mi->bi', per_model, constrained_mergers).reshape(ctx.orig_shape)
+        if ctx.needs_input_grad[2]:
+            grad_mergers = torch.einsum('mbi,bi->mi', per_model, x)
+
+        return grad_hidden_states, None, grad_mergers
+
+
+def dam_fused_linear(hidden_states, weights, constrained_mergers):
+    """Compute sum_m (hidden_states * constrained_mergers[m]) @ weights[m].T.
+
+    Uses the Triton kernel when available and the tensors live on CUDA, so the
+    merged weight is never materialized; otherwise falls back to the einsum form.
+    """
+    if triton is None or not hidden_states.is_cuda:
+        return _dam_linear_reference(hidden_states, weights, constrained_mergers)
+    return _DAMFusedLinear.apply(hidden_states, weights, constrained_mergers)
@@ -27,6 +27,7 @@ from transformers.utils import (
     replace_return_docstrings,
 )
 from .config import MergedMistralConfig
+from ..checkpoint_compat import load_legacy_dam_tensors
 from ..dam import DAMLinearLayer, DAMEmbeddingLayer, DAMRMSNorm
 
 if is_flash_attn_2_available():
@@ -599,6 +600,20 @@ class MergedMistralPreTrainedModel(PreTrainedModel):
             if module.padding_idx is not None:
                 module.weight.data[module.padding_idx].zero_()
 
+    @classmethod
+    def from_pretrained(cls, pretrained_model_name_or_path, *model_args, **kwargs):
+        hub_kwargs = {
+            name: kwargs[name]
+            for name in ("cache_dir", "revision", "token", "subfolder", "local_files_only")
+            if name in kwargs
+        }
+        model = super().from_pretrained(pretrained_model_name_or_path, *model_args, **kwargs)
+        # Checkpoints saved before the DAM parameters were stacked keep their indexed
+        # per-model keys; the low-memory loading path used with a device_map skips the
+        # module-level remap in DAMBaseLayer, so stack them into the loaded model here
+        load_legacy_dam_tensors(model, pretrained_model_name_or_path, **hub_kwargs)
+        return model
+
 
 MISTRAL_INPUTS_DOCSTRING = r"""
     Args:
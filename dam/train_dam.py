@@ -64,6 +64,9 @@ def main(temperature, weight_decay, learning_rate,
     # Load the dataset
     # dataset = load_from_disk(combined_hf_dataset_dir)
     dataset = load_dataset(combined_hf_dataset_dir, split="train")
+    # Keep the Arrow storage dtypes (fp16 top-K logits, int32 indices) when batches are
+    # built: the default python format would rebuild everything as float32/int64 lists
+    dataset = dataset.with_format("torch")
 
     # Training arguments
     training_args = TrainingArguments(